@@ -1,30 +1,70 @@
 import ast
 import errno
-from json import loads, dumps
-import base64
 from os import environ as env, kill
-from signal import signal, SIGSTOP, SIGTERM, SIGCHLD, SIG_IGN
+from signal import signal, SIGSTOP, SIGTERM, SIGCHLD, SIG_DFL, SIG_IGN
 from socket import (
     error as socket_error,
     AF_INET,
+    IPPROTO_TCP,
+    SHUT_WR,
     SOCK_STREAM,
     SO_REUSEPORT,
     SOL_SOCKET,
+    TCP_NODELAY,
 )
+from struct import Struct
+from time import time
 from sys import exit
 from logging import getLogger
-from asyncore import dispatcher, loop
-
-from collections import Counter
+from asyncore import close_all, dispatcher, loop
+from binascii import a2b_base64
+
+from collections import defaultdict, deque
+from functools import partial
+from hashlib import sha1
+from mmap import mmap
+from fcntl import lockf, LOCK_EX, LOCK_NB, LOCK_UN
 from multiprocessing import current_process, cpu_count, Process
+from tempfile import TemporaryFile
+from zlib import crc32
 
 import rsyslog
 
 from stdlib_list import stdlib_list
 
+try:
+    # ujson is a C encoder/decoder, much faster than the standard library on large use_count dicts
+    from ujson import loads, dumps
+except ImportError:
+    from json import loads, dumps as json_dumps
+    # without whitespace, which is a fair share of a use_count response
+    dumps = partial(json_dumps, separators=(',', ':'))
+
 LOGGER = getLogger()
 
-STANDARD_LIBRARY = stdlib_list('2.7')
+STANDARD_LIBRARY = frozenset(stdlib_list('2.7'))
+
+_BASE_BINDINGS = { name: '__stdlib__.' + name for name in STANDARD_LIBRARY }
+
+_GRAMMAR_PREFIX = '__stdlib__.__grammar__.'
+
+
+def grammar_key(node_type):
+    return intern(_GRAMMAR_PREFIX + node_type.__name__)
+
+
+class GrammarKeys(dict):
+    # use_count key of each AST node type, built once per process instead of once per visited node
+
+    def __missing__(self, node_type):
+        key = self[node_type] = grammar_key(node_type)
+        return key
+
+
+_GRAMMAR_KEYS = GrammarKeys(
+    (node_type, grammar_key(node_type))
+    for node_type in vars(ast).values() if isinstance(node_type, type) and issubclass(node_type, ast.AST)
+)
 
 
 class ReferenceCollector(ast.NodeVisitor):
@@ -32,23 +72,50 @@ class ReferenceCollector(ast.NodeVisitor):
 
     def __init__(self, private_namespace):
         super(ReferenceCollector, self).__init__()
+        # names bound by the private namespace and the code, standard library names are in the shared _BASE_BINDINGS
         self.bindings = dict()
-        self.use_count = Counter()
-        self.bindings.update({ name: '__private__.' + name for name in private_namespace })
-        self.bindings.update({ name: '__stdlib__.' + name for name in STANDARD_LIBRARY })
+        self.use_count = defaultdict(int)
+        self.reset(private_namespace)
+
+    def reset(self, private_namespace):
+        # lets a worker reuse the same collector for every request instead of allocating a new one
+        self.bindings.clear()
+        # standard library names take precedence over private ones
+        self.bindings.update({ name: '__private__.' + name for name in private_namespace if name not in STANDARD_LIBRARY })
+        self.use_count.clear()
 
     def add_grammar(self, node):
-        self.use_count.update(['__stdlib__.__grammar__.' + node.__class__.__name__])
+        self.use_count[_GRAMMAR_KEYS[type(node)]] += 1
 
     def visit(self, node):
-        super(ReferenceCollector, self).visit(node)
-
-    def generic_visit(self, node):
-        self.add_grammar(node)
-        super(ReferenceCollector, self).generic_visit(node)
+        # Walks the tree in the same order as NodeVisitor, but from an explicit stack instead of recursing
+        # through visit and generic_visit, and dispatching on the node type instead of a getattr of 'visit_' + class name.
+        # A node with a handler is left to it, along with its children.
+        use_count = self.use_count
+        dispatch = self._DISPATCH
+        stack = [ node ]
+        while stack:
+            node = stack.pop()
+            node_type = type(node)
+            handler = dispatch.get(node_type)
+            if handler is not None:
+                handler(self, node)
+                continue
+            use_count[_GRAMMAR_KEYS[node_type]] += 1
+            children = []
+            for field in node._fields:
+                value = getattr(node, field, None)
+                if isinstance(value, list):
+                    for item in value:
+                        if isinstance(item, ast.AST):
+                            children.append(item)
+                elif isinstance(value, ast.AST):
+                    children.append(value)
+            children.reverse()
+            stack.extend(children)
 
     def add_binding(self, bound_name, *real_attributes):
-        if bound_name in self.bindings:
+        if bound_name in self.bindings or bound_name in _BASE_BINDINGS:
             return
         elif real_attributes[0] in STANDARD_LIBRARY:
             self.bindings[bound_name] = '.'.join(['__stdlib__'] + list(real_attributes))
@@ -57,15 +124,6 @@ class ReferenceCollector(ast.NodeVisitor):
         else:
             self.bindings[bound_name] = '.'.join(real_attributes)
 
-    def add_use(self, *attributes):
-        if attributes[0] not in self.bindings:
-            # we can't know all bindings, because of imports like "from foo import *"
-            # In such a case, we can't really do anything with the reference
-            return
-        real_name = self.bindings[attributes[0]]
-        full_name = '.'.join([real_name] + list(attributes[1:]))
-        self.use_count.update([ full_name ])
-
     def visit_Import(self, node):
         self.add_grammar(node)
         for alias in node.names:
@@ -83,76 +141,258 @@ class ReferenceCollector(ast.NodeVisitor):
             pass
 
     def visit_Attribute(self, attribute):
-        name = self.get_name(attribute)
-        self.add_use(*name)
-        self.add_grammar(attribute)
-
-    def get_name(self, node):
-        if isinstance(node, ast.Name):
-            return [ node.id ]
-        elif isinstance(node, ast.Attribute):
-            return self.get_attribute_name(node)
-        elif isinstance(node, ast.Call):
-            return self.get_call_name(node)
-        elif isinstance(node, ast.Subscript):
-            return self.get_name(node.value)
-        else:
-            return []
-
-    def get_attribute_name(self, attribute):
-        self.add_grammar(attribute)
-        attributes = []
+        # walks the whole chain at once, e.g. a.b().c[0].d, collecting names from the outermost inwards;
+        # the first attribute of each run of attributes and every call count towards the grammar
+        use_count = self.use_count
+        names = []
         expression = attribute
-        while isinstance(expression, ast.Attribute):
-            attributes.insert(0, expression.attr)
-            expression = expression.value
-        attributes = self.get_name(expression) + attributes
-        return attributes
-
-    def get_call_name(self, call):
-        self.add_grammar(call)
-        return self.get_name(call.func)
+        parent_type = None
+        while True:
+            expression_type = type(expression)
+            if expression_type is ast.Attribute:
+                if parent_type is not ast.Attribute:
+                    use_count[_GRAMMAR_KEYS[ast.Attribute]] += 1
+                names.append(expression.attr)
+                expression = expression.value
+            elif expression_type is ast.Call:
+                use_count[_GRAMMAR_KEYS[ast.Call]] += 1
+                expression = expression.func
+            elif expression_type is ast.Subscript:
+                expression = expression.value
+            else:
+                if expression_type is ast.Name:
+                    names.append(expression.id)
+                break
+            parent_type = expression_type
+        base = names.pop()
+        real_name = self.bindings.get(base) or _BASE_BINDINGS.get(base)
+        if real_name is not None:
+            names.append(real_name)
+            use_count['.'.join(reversed(names))] += 1
+        use_count[_GRAMMAR_KEYS[ast.Attribute]] += 1
 
     def visit_Name(self, name):
         self.add_grammar(name)
-        if name.id in self.bindings:
-            self.add_use(name.id)
+        real_name = self.bindings.get(name.id) or _BASE_BINDINGS.get(name.id)
+        # we can't know all bindings, because of imports like "from foo import *"
+        # In such a case, we can't really do anything with the reference
+        if real_name is not None:
+            self.use_count[real_name] += 1
+
+    _DISPATCH = {
+        ast.Import: visit_Import,
+        ast.ImportFrom: visit_ImportFrom,
+        ast.Attribute: visit_Attribute,
+        ast.Name: visit_Name,
+    }
+
+
+
+class SharedCache(object):
+    # Lives in an anonymous shared memory map, so it must be created before forking the workers that share it.
+    # The map starts with the offset where the next value will be written, followed by a table of slots indexed
+    # by key, each pointing to a value in a ring buffer taking the rest of the map.
+    # Readers don't lock: every value repeats its key and is stored with a checksum,
+    # so a value that gets overwritten while it's being read is just a miss.
+    # Writers don't wait for each other: if another process is writing, the value is not cached.
+    # They lock with a POSIX record lock on an anonymous file, which the kernel releases when its owner dies,
+    # so a worker killed while writing doesn't keep the others from ever writing again.
+
+    KEY_INDEX = Struct('>Q')
+    NEXT_OFFSET = Struct('>Q')
+    SLOT = Struct('>20sQI') # key, offset and length of the value
+    ENTRY = Struct('>20sII') # key, length and checksum of the value following it
+
+    def __init__(self, size, slot_count):
+        self.memory = mmap(-1, size)
+        self.size = size
+        self.slot_count = slot_count
+        self.values_offset = self.NEXT_OFFSET.size + slot_count * self.SLOT.size
+        self.lock_file = TemporaryFile()
+        self.NEXT_OFFSET.pack_into(self.memory, 0, self.values_offset)
+
+    def acquire(self):
+        try:
+            lockf(self.lock_file, LOCK_EX | LOCK_NB)
+        except IOError as e:
+            if e.errno in (errno.EACCES, errno.EAGAIN):
+                LOGGER.debug('Not caching, another process is writing to the cache')
+                return False
+            raise
+        return True
+
+    def release(self):
+        lockf(self.lock_file, LOCK_UN)
+
+    def slot_offset(self, key):
+        index, = self.KEY_INDEX.unpack_from(key)
+        return self.NEXT_OFFSET.size + (index % self.slot_count) * self.SLOT.size
+
+    def get(self, key):
+        slot_key, offset, length = self.SLOT.unpack_from(self.memory, self.slot_offset(key))
+        if slot_key != key:
+            return None
+        # the slot may be read while it's being written, with the right key but a torn offset or length
+        if offset < self.values_offset or offset + self.ENTRY.size + length > self.size:
+            return None
+        entry_key, entry_length, checksum = self.ENTRY.unpack_from(self.memory, offset)
+        start = offset + self.ENTRY.size
+        value = self.memory[start:start + length]
+        if entry_key != key or entry_length != length or crc32(value) & 0xffffffff != checksum:
+            return None
+        return value
+
+    def put(self, key, value):
+        length = len(value)
+        if self.values_offset + self.ENTRY.size + length > self.size:
+            return
+        if not self.acquire():
+            return
+        try:
+            offset, = self.NEXT_OFFSET.unpack_from(self.memory, 0)
+            # the next offset may be garbage if a writer died while updating it
+            if offset < self.values_offset or offset + self.ENTRY.size + length > self.size:
+                offset = self.values_offset
+            self.ENTRY.pack_into(self.memory, offset, key, length, crc32(value) & 0xffffffff)
+            start = offset + self.ENTRY.size
+            self.memory[start:start + length] = value
+            self.SLOT.pack_into(self.memory, self.slot_offset(key), key, offset, length)
+            self.NEXT_OFFSET.pack_into(self.memory, 0, start + length)
+        finally:
+            self.release()
+
+
+def cache_key(code, private_modules):
+    digest = sha1(code)
+    for name in private_modules:
+        digest.update(b'\0' + name.encode('utf-8'))
+    return digest.digest()
+
+
+# the same files get submitted over and over again (retries, successive commits of a repository),
+# so all the workers share the encoded response to recently parsed code, keyed by its digest and the private modules
+RESPONSE_CACHE = SharedCache(256 * 1024 * 1024, 64 * 1024)
 
 
+# a worker handles one request at a time
+REFERENCE_COLLECTOR = ReferenceCollector([])
+
 
 TRY_AGAIN_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK)
 
 
+DISCONNECTED_ERRORS = (errno.ECONNRESET, errno.ENOTCONN, errno.ESHUTDOWN, errno.ECONNABORTED, errno.EPIPE, errno.EBADF)
+
+
+# every request is a JSON document prefixed with its length, as a 4-byte big-endian unsigned int
+REQUEST_HEADER = Struct('>I')
+
+
+# a longer request is refused and its connection closed, without reading or allocating room for the payload:
+# a garbled header, or a client that doesn't send one at all, would otherwise have us wait for up to 4 GB
+MAX_REQUEST_LENGTH = 64 * 1024 * 1024
+
+
 class RequestHandler(dispatcher):
 
-    def __init__(self, sock, address, buffer_size=4096):
+    def __init__(self, sock, address, buffer_size=65536):
         dispatcher.__init__(self, sock=sock)
         self.address = address
         self.buffer_size = buffer_size
-        self.data_as_str = ''
-        self.encoded_response = ''
+        self.close_when_sent = False
+        self.draining = False
+        self.expect_header()
+        self.respond('')
+
+    def expect_header(self):
+        self.request_length = None
+        self.request_buffer = bytearray(REQUEST_HEADER.size)
+        self.received = 0
+
+    def readable(self):
+        # a pipelined request waits in the socket until the response before it is sent
+        return self.sent >= len(self.encoded_response) and (self.draining or not self.close_when_sent)
+
+    def drain(self):
+        # closing with unread input makes the kernel reset the connection, and the client could lose the response,
+        # so what the client sends after we've stopped writing is discarded until it closes its end
+        discarded = len(self.recv(self.buffer_size))
+        self.received += discarded
+        if discarded and self.received > MAX_REQUEST_LENGTH:
+            self.close()
 
     def handle_read(self):
+        if self.draining:
+            self.drain()
+            return
+        # we receive straight into a buffer sized for what we expect next, the header or the payload,
+        # instead of allocating a string on every read and appending it to what we have so far
+        view = memoryview(self.request_buffer)[self.received:]
         try:
-            data = self.recv(self.buffer_size)
+            received = self.socket.recv_into(view, min(len(view), self.buffer_size))
         except socket_error as e:
             if e.errno and e.errno in TRY_AGAIN_ERRORS:
                 return
+            elif e.errno in DISCONNECTED_ERRORS:
+                self.handle_close()
+                return
             else:
                 self.handle_error()
                 return
-        self.data_as_str += data.decode('utf-8').strip()
+        finally:
+            # the buffer can't be resized while a view of it exists
+            del view
+        if not received:
+            self.handle_close()
+            return
+        self.received += received
+        if self.received < len(self.request_buffer):
+            return
+        if self.request_length is None:
+            self.request_length, = REQUEST_HEADER.unpack_from(self.request_buffer)
+            if self.request_length > MAX_REQUEST_LENGTH:
+                LOGGER.error('Refusing request of %d bytes from %s', self.request_length, self.address)
+                self.respond(dumps({
+                    'error': errno.EINVAL,
+                    'message': 'request of {} bytes exceeds the maximum of {}, '
+                        'requests must be prefixed with their length as a 4-byte big-endian unsigned int'.format(
+                        self.request_length,
+                        MAX_REQUEST_LENGTH,
+                    ),
+                }))
+                self.close_when_sent = True
+                return
+            # the buffer grows as the payload arrives, so that the header alone doesn't decide how much we allocate
+            self.request_buffer = bytearray(min(self.request_length, self.buffer_size))
+            self.received = 0
+            if self.request_length:
+                return
+        elif self.received < self.request_length:
+            self.request_buffer += bytearray(min(self.request_length - self.received, self.received))
+            return
+        payload = bytes(self.request_buffer)
+        self.expect_header()
         try:
-            request = loads(self.data_as_str)
-            self.data_as_str = ''
-        except ValueError:
+            request = loads(payload)
+        except ValueError as exc:
+            self.respond(dumps({ 'error': errno.EINVAL, 'message': str(exc) }))
             return
         try:
-            code = base64.b64decode(request['code'].encode('utf-8'))
+            code = a2b_base64(request['code'])
             context = request['context']
-            reference_collector = ReferenceCollector(context['private_modules'] if 'private_modules' in context else [])
-            reference_collector.visit(ast.parse(code, filename = context['filename'] if 'filename' in context else '<unknown>'))
-            response = { 'use_count': reference_collector.use_count }
+            private_modules = context.get('private_modules', ())
+            key = cache_key(code, private_modules)
+            encoded_response = RESPONSE_CACHE.get(key)
+            if encoded_response is None:
+                reference_collector = REFERENCE_COLLECTOR
+                reference_collector.reset(private_modules)
+                filename = context.get('filename', '<unknown>')
+                # same as ast.parse, minus a python call, and without inheriting this module's __future__ flags
+                reference_collector.visit(compile(code, filename, 'exec', ast.PyCF_ONLY_AST, True))
+                encoded_response = dumps({ 'use_count': reference_collector.use_count })
+                RESPONSE_CACHE.put(key, encoded_response)
+            self.respond(encoded_response)
+            return
         except KeyError as exc:
             response = { 'error': errno.EINVAL, 'message': str(exc) }
         except ValueError as exc:
@@ -168,21 +408,38 @@ class RequestHandler(dispatcher):
         except Exception as exc:
             LOGGER.exception('Unhandled exception')
             response = { 'error': errno.EIO, 'message': str(exc) }
-        self.encoded_response = dumps(response)
+        self.respond(dumps(response))
+
+    def respond(self, encoded_response):
+        self.encoded_response = encoded_response
+        self.sent = 0
+
+    def writable(self):
+        # otherwise the loop keeps polling for, and calling handle_write on, idle connections
+        return self.sent < len(self.encoded_response)
 
     def handle_write(self):
-        if self.encoded_response:
-            sent = self.send(self.encoded_response)
-            self.encoded_response = self.encoded_response[sent:]
+        # sending from a memoryview doesn't copy what's left of the response after every partial send
+        self.sent += self.send(memoryview(self.encoded_response)[self.sent:])
+        if self.sent == len(self.encoded_response):
+            self.respond('')
+            if self.close_when_sent:
+                try:
+                    self.socket.shutdown(SHUT_WR)
+                except socket_error:
+                    self.close()
+                    return
+                self.draining = True
+                self.received = 0
 
     def handle_error(self):
         LOGGER.exception('Error in connection with {}'.format(self.address))
-        self.encoded_response = ''
+        self.respond('')
 
 
 class ConnectionHandler(dispatcher):
 
-    def __init__(self, host, port, request_buffer_size=4096):
+    def __init__(self, host, port, request_buffer_size=65536):
         dispatcher.__init__(self)
         self.create_socket(AF_INET, SOCK_STREAM)
         self.set_reuse_addr()
@@ -195,14 +452,18 @@ class ConnectionHandler(dispatcher):
         # Also, long-live processes hold resources whether we use the service or not.
         # Up side is the implementation is trivial: just fork the process before the listening socket is setup.
         self.bind((host, port))
-        self.listen(5)
+        # clients open many connections at once, don't refuse them because the accept queue is full
+        self.listen(1024)
         self.request_buffer_size = request_buffer_size
         LOGGER.debug('Listening at %s:%s',  host, port)
 
     def handle_accept(self):
         pair = self.accept()
         if pair:
-            RequestHandler(*pair, buffer_size=self.request_buffer_size)
+            sock, address = pair
+            # responses are written at once, don't let Nagle's algorithm hold back their last segment
+            sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+            RequestHandler(sock, address, buffer_size=self.request_buffer_size)
 
     def handle_close(self):
         LOGGER.debug('Closing listening socket')
@@ -224,9 +485,41 @@ class ConnectionHandler(dispatcher):
             LOGGER.exception('Trying to set the SO_REUSEPORT option on the listening socket')
 
 
+# a child that keeps crashing is not restarted more than this many times in this many seconds
+RESTART_LIMIT = 5
+
+
+RESTART_WINDOW = 60
+
+
+class RestartBudget(object):
+
+    def __init__(self, limit=RESTART_LIMIT, window=RESTART_WINDOW):
+        self.window = window
+        self.restarts = deque(maxlen=limit)
+
+    def spend(self, now):
+        if len(self.restarts) == self.restarts.maxlen and now - self.restarts[0] < self.window:
+            return False
+        self.restarts.append(now)
+        return True
+
+
+def new_child(address, port, index):
+    return Process(
+        target=async_loop,
+        args=(address, port),
+        name='python_2_parser.child.'+str(index)
+    )
+
+
 def async_loop(address, port, is_child=True, children=None):
     rsyslog.setup(log_level = env['LOG_LEVEL'] if 'LOG_LEVEL' in env else 'DEBUG')
     LOGGER.info('Booted')
+    if is_child:
+        # a child restarted by the master inherits its listening socket, don't serve it from here
+        close_all()
+        signal(SIGCHLD, SIG_DFL)
     server = ConnectionHandler(address, port)
     if is_child:
         def shutdown_child(sig, frame):
@@ -235,26 +528,50 @@ def async_loop(address, port, is_child=True, children=None):
         signal(SIGTERM, shutdown_child)
     else:
         def shutdown_master(sig, frame):
+            signal(SIGCHLD, SIG_IGN) # children are expected to exit now, let them go without zombies
             server.close()
             for child in children:
-                kill(child.pid, SIGTERM)
+                # a child that has exited was reaped by is_alive(), its pid may belong to another process by now
+                if child.exitcode is not None:
+                    continue
+                try:
+                    kill(child.pid, SIGTERM)
+                except OSError as e:
+                    # it exited since, and was reaped because SIGCHLD is ignored
+                    if e.errno != errno.ESRCH:
+                        raise
             LOGGER.info('QUIT')
             exit(SIGTERM)
+        budgets = [ RestartBudget() for child in children ]
+        given_up = set()
+        def restart_children(sig, frame):
+            for index, child in enumerate(children):
+                # is_alive() reaps the child if it has exited, a child that is not started yet has no exit code
+                if index in given_up or child.is_alive() or child.exitcode in (None, 0):
+                    continue
+                if not budgets[index].spend(time()):
+                    LOGGER.error(
+                        '%s exited with code %s, it was restarted %d times in %d seconds, giving up on it',
+                        child.name, child.exitcode, RESTART_LIMIT, RESTART_WINDOW
+                    )
+                    given_up.add(index)
+                    continue
+                LOGGER.error('%s exited with code %s, restarting it', child.name, child.exitcode)
+                child = children[index] = new_child(address, port, index)
+                child.start()
         signal(SIGTERM, shutdown_master)
-        signal(SIGCHLD, SIG_IGN) # we don't join with children and don't want zombie
-    loop()
+        signal(SIGCHLD, restart_children)
+    # poll() has no FD_SETSIZE limit and doesn't rebuild three fd lists on every iteration like select() does
+    loop(use_poll=True)
 
 
-def main(address, port):
+def main(address, port, workers=None):
     current_process().name = 'python_2_parser.master'
-    children = [
-        Process(
-            target=async_loop,
-            args=(address, port),
-            name='python_2_parser.child.'+str(i)
-        ) for i in range(cpu_count() - 1)
-    ]
-    map(Process.start, children)
+    if workers is None:
+        workers = cpu_count() - 1
+    children = [ new_child(address, port, i) for i in range(workers) ]
+    for child in children:
+        child.start()
     async_loop(address, port, is_child=False, children=children)
 
 
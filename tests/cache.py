@@ -0,0 +1,70 @@
+from hashlib import sha1
+from multiprocessing import Process
+from os import getpid, kill
+from signal import SIGKILL
+from unittest import TestCase, main as _main
+
+from run import SharedCache
+
+
+def key(name):
+    return sha1(name).digest()
+
+
+def put(cache, name, value):
+    cache.put(key(name), value)
+
+
+def die_while_writing(cache):
+    cache.acquire()
+    kill(getpid(), SIGKILL)
+
+
+class SharedCacheTest(TestCase):
+
+    def setUp(self):
+        self.cache = SharedCache(4096, 16)
+
+    def test_miss(self):
+        self.assertIsNone(self.cache.get(key('foo')))
+
+    def test_hit(self):
+        put(self.cache, 'foo', 'bar')
+        self.assertEqual(self.cache.get(key('foo')), 'bar')
+
+    def test_value_too_big(self):
+        put(self.cache, 'foo', 4096*'x')
+        self.assertIsNone(self.cache.get(key('foo')))
+
+    def test_overwritten_value(self):
+        # values are written in a ring buffer, big enough for only one of these
+        put(self.cache, 'foo', 3000*'x')
+        put(self.cache, 'bar', 3000*'y')
+        self.assertIsNone(self.cache.get(key('foo')))
+        self.assertEqual(self.cache.get(key('bar')), 3000*'y')
+
+    def test_torn_slot(self):
+        put(self.cache, 'foo', 'bar')
+        slot_offset = self.cache.slot_offset(key('foo'))
+        SharedCache.SLOT.pack_into(self.cache.memory, slot_offset, key('foo'), 4096, 3)
+        self.assertIsNone(self.cache.get(key('foo')))
+        SharedCache.SLOT.pack_into(self.cache.memory, slot_offset, key('foo'), 0, 3)
+        self.assertIsNone(self.cache.get(key('foo')))
+
+    def test_writer_died_while_writing(self):
+        child = Process(target=die_while_writing, args=(self.cache,))
+        child.start()
+        child.join()
+        self.assertEqual(child.exitcode, -SIGKILL)
+        put(self.cache, 'foo', 'bar')
+        self.assertEqual(self.cache.get(key('foo')), 'bar')
+
+    def test_shared_with_children(self):
+        child = Process(target=put, args=(self.cache, 'foo', 'bar'))
+        child.start()
+        child.join()
+        self.assertEqual(self.cache.get(key('foo')), 'bar')
+
+
+if __name__ == '__main__':
+    _main()
@@ -91,30 +91,40 @@ class Collector(unittest.TestCase):
         self.assertEqual(uses.pop('__stdlib__.os.path.abspath'), 3)
         self.assertEqual(uses.pop('__stdlib__.os.path.dirname'), 1)
         self.assertEqual(uses.pop('__stdlib__.pprint.PrettyPrinter'), 1)
-        self.assertEqual(uses.pop('__stdlib__.comprehension'), 1)
-        self.assertEqual(uses.pop('__stdlib__.Load'), 3)
-        self.assertEqual(uses.pop('__stdlib__.Assign'), 9)
-        self.assertEqual(uses.pop('__stdlib__.Attribute'), 20)
-        self.assertEqual(uses.pop('__stdlib__.Call'), 16)
-        self.assertEqual(uses.pop('__stdlib__.Expr'), 8)
-        self.assertEqual(uses.pop('__stdlib__.Import'), 2)
-        self.assertEqual(uses.pop('__stdlib__.ImportFrom'), 11)
-        self.assertEqual(uses.pop('__stdlib__.Module'), 1)
-        self.assertEqual(uses.pop('__stdlib__.Name'), 23)
-        self.assertEqual(uses.pop('__stdlib__.Str'), 7)
-        self.assertEqual(uses.pop('__stdlib__.List'), 2)
-        self.assertEqual(uses.pop('__stdlib__.ListComp'), 1)
-        self.assertEqual(uses.pop('__stdlib__.Num'), 6)
-        self.assertEqual(uses.pop('__stdlib__.ClassDef'), 1)
-        self.assertEqual(uses.pop('__stdlib__.FunctionDef'), 1)
-        self.assertEqual(uses.pop('__stdlib__.Index'), 1)
-        self.assertEqual(uses.pop('__stdlib__.Print'), 1)
-        self.assertEqual(uses.pop('__stdlib__.Subscript'), 1)
-        self.assertEqual(uses.pop('__stdlib__.arguments'), 1)
-        self.assertEqual(uses.pop('__stdlib__.keyword'), 1)
+        self.assertEqual(uses.pop('__stdlib__.__grammar__.comprehension'), 1)
+        self.assertEqual(uses.pop('__stdlib__.__grammar__.Load'), 3)
+        self.assertEqual(uses.pop('__stdlib__.__grammar__.Assign'), 9)
+        self.assertEqual(uses.pop('__stdlib__.__grammar__.Attribute'), 20)
+        self.assertEqual(uses.pop('__stdlib__.__grammar__.Call'), 16)
+        self.assertEqual(uses.pop('__stdlib__.__grammar__.Expr'), 8)
+        self.assertEqual(uses.pop('__stdlib__.__grammar__.Import'), 2)
+        self.assertEqual(uses.pop('__stdlib__.__grammar__.ImportFrom'), 11)
+        self.assertEqual(uses.pop('__stdlib__.__grammar__.Module'), 1)
+        self.assertEqual(uses.pop('__stdlib__.__grammar__.Name'), 23)
+        self.assertEqual(uses.pop('__stdlib__.__grammar__.Str'), 7)
+        self.assertEqual(uses.pop('__stdlib__.__grammar__.List'), 2)
+        self.assertEqual(uses.pop('__stdlib__.__grammar__.ListComp'), 1)
+        self.assertEqual(uses.pop('__stdlib__.__grammar__.Num'), 6)
+        self.assertEqual(uses.pop('__stdlib__.__grammar__.ClassDef'), 1)
+        self.assertEqual(uses.pop('__stdlib__.__grammar__.FunctionDef'), 1)
+        self.assertEqual(uses.pop('__stdlib__.__grammar__.Index'), 1)
+        self.assertEqual(uses.pop('__stdlib__.__grammar__.Print'), 1)
+        self.assertEqual(uses.pop('__stdlib__.__grammar__.Subscript'), 1)
+        self.assertEqual(uses.pop('__stdlib__.__grammar__.arguments'), 1)
+        self.assertEqual(uses.pop('__stdlib__.__grammar__.keyword'), 1)
         self.assertEqual(uses.pop('__private__.my_private_pkg.is_da_bomb'), 1)
         self.assertEqual(uses.pop('__private__.yfget.Converter.str_to_nplaces'), 1)
         self.assertEqual(dict(uses), {})
 
+    def test_reset(self):
+        reference_collector = ReferenceCollector(['my_private_pkg'])
+        reference_collector.visit(self.py3_ast)
+        reference_collector.reset(['yfget'])
+        reference_collector.visit(self.py3_ast)
+        new_reference_collector = ReferenceCollector(['yfget'])
+        new_reference_collector.visit(self.py3_ast)
+        self.assertEqual(reference_collector.bindings, new_reference_collector.bindings)
+        self.assertEqual(reference_collector.use_count, new_reference_collector.use_count)
+
 if __name__ == '__main__':
     unittest.main()
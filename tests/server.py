@@ -1,16 +1,17 @@
 from asyncore import loop
 from base64 import b64encode
 from contextlib import contextmanager
-from json import loads, dumps
+from errno import EINVAL
+from json import JSONDecoder, loads, dumps
 from logging import getLogger
-from multiprocessing import Process, Pipe, current_process
-from os import kill
-from signal import SIGSTOP, SIGTERM
-from socket import socket, AF_INET, SOCK_STREAM
-from time import sleep
+from multiprocessing import Event, Process, Pipe, current_process
+from os import kill, listdir
+from signal import SIGKILL, SIGSTOP, SIGTERM
+from socket import socket, AF_INET, SHUT_WR, SOCK_STREAM, SOL_SOCKET, SO_RCVBUF
+from time import sleep, time
 from unittest import TestCase, main as _main
 
-from run import ConnectionHandler, main as server_main
+from run import ConnectionHandler, MAX_REQUEST_LENGTH, REQUEST_HEADER, RESTART_LIMIT, RestartBudget, main as server_main
 
 from tests import log_to_stdout
 
@@ -50,10 +51,11 @@ FAT_CODE = (20*REQUEST_BUFFER_SIZE//len(CODE))*CODE
 
 
 def request(code):
-    return dumps({
+    payload = dumps({
         'code': b64encode(code),
         'context': {},
     })
+    return REQUEST_HEADER.pack(len(payload)) + payload
 
 REQUEST = request(CODE)
 
@@ -61,10 +63,18 @@ REQUEST = request(CODE)
 FAT_REQUEST = request(FAT_CODE)
 
 
-def main():
+def main(listening):
     current_process().name = 'Server'
     server = ConnectionHandler(*SERVER_ADDRESS, request_buffer_size=REQUEST_BUFFER_SIZE)
-    loop()
+    listening.set()
+    loop(use_poll=True)
+
+
+def send(data):
+    s = socket(AF_INET, SOCK_STREAM)
+    s.connect(SERVER_ADDRESS)
+    s.sendall(data)
+    return s
 
 
 def client(pipe, connections):
@@ -91,6 +101,37 @@ def client(pipe, connections):
         s.close()
 
 
+def process_status(pid):
+    try:
+        with open('/proc/%s/stat' % pid) as stat:
+            # the command name is in parentheses and may contain spaces, the state and parent pid follow it
+            state, parent = stat.read().rsplit(')', 1)[1].split()[:2]
+    except IOError:
+        return None, None # the process exited
+    return state, int(parent)
+
+
+def is_running(pid):
+    state, _ = process_status(pid)
+    return state not in (None, 'Z')
+
+
+def children_of(pid):
+    return [
+        int(entry) for entry in listdir('/proc')
+        if entry.isdigit() and process_status(entry)[1] == pid and is_running(entry)
+    ]
+
+
+def wait_for_children(pid, count, timeout=5, exclude=None):
+    deadline = time() + timeout
+    children = children_of(pid)
+    while (len(children) != count or exclude in children) and time() < deadline:
+        sleep(0.05)
+        children = children_of(pid)
+    return children
+
+
 def launch_client(_id, connections):
     pipe, client_pipe = Pipe()
     process = Process(target=client, args=(client_pipe, connections), name='Client '+str(_id))
@@ -99,16 +140,17 @@ def launch_client(_id, connections):
 
 
 @contextmanager
-def parser():
+def parser(workers=None):
     server = Process(
         target=server_main,
-        args=SERVER_ADDRESS,
+        args=SERVER_ADDRESS + (workers,),
     )
     server.start()
     sleep(1)
     yield server
     if server.is_alive():
         server.terminate()
+        server.join()
 
 
 class AsyncTest(TestCase):
@@ -116,12 +158,17 @@ class AsyncTest(TestCase):
     def setUp(self):
         current_process().name = 'unittest'
         log_to_stdout()
-        self.process = Process(target=main)
+        listening = Event()
+        self.process = Process(target=main, args=(listening,))
         self.process.start()
+        # clients would be refused if they connected before the server listens
+        listening.wait(5)
 
     def tearDown(self):
         if self.process.is_alive():
             self.process.terminate()
+            # the next test's server shares the port, connections must not go to this one while it's exiting
+            self.process.join()
 
     def evaluate_client_response(self, response):
         self.assertIsNotNone(response)
@@ -164,12 +211,92 @@ class AsyncTest(TestCase):
             pipe.send('') # shutdown signal
             process.join()
 
+    def evaluate_error_response(self, s, error):
+        response = s.recv(1024)
+        try:
+            obj = loads(response)
+        except:
+            self.fail('cannot load error response as JSON')
+        self.assertEqual(obj['error'], error)
+        self.assertIn('message', obj)
+
+    def test_request_not_json(self):
+        s = send(REQUEST_HEADER.pack(len('{nope')) + '{nope')
+        self.evaluate_error_response(s, EINVAL)
+        s.close()
+
+    def test_empty_request(self):
+        s = send(REQUEST_HEADER.pack(0))
+        self.evaluate_error_response(s, EINVAL)
+        s.close()
+
+    def test_request_too_long(self):
+        s = send(REQUEST_HEADER.pack(MAX_REQUEST_LENGTH + 1))
+        self.evaluate_error_response(s, EINVAL)
+        self.assertEqual(s.recv(1024), '', 'connection should be closed')
+        s.close()
+
+    def test_request_without_length(self):
+        # a legacy client sends bare JSON, whose first bytes are read as a length way over the maximum
+        s = send(REQUEST[REQUEST_HEADER.size:])
+        self.evaluate_error_response(s, EINVAL)
+        # the rest of the request was discarded, so the connection is closed gracefully instead of being reset
+        self.assertEqual(s.recv(1024), '', 'connection should be closed')
+        s.close()
+
+    def test_pipelined_requests(self):
+        # the first response is bigger than the socket buffers, so it's still being sent when the second request arrives
+        code = 'import os\n' + ''.join('os.attribute_%d\n' % i for i in range(100000))
+        s = socket(AF_INET, SOCK_STREAM)
+        s.setsockopt(SOL_SOCKET, SO_RCVBUF, 4096)
+        s.connect(SERVER_ADDRESS)
+        s.sendall(request(code) + REQUEST)
+        s.shutdown(SHUT_WR)
+        responses = []
+        while True:
+            data = s.recv(65536)
+            if not data:
+                break
+            responses.append(data)
+        s.close()
+        responses = ''.join(responses)
+        decoder = JSONDecoder()
+        first, end = decoder.raw_decode(responses)
+        second, end = decoder.raw_decode(responses, end)
+        self.assertEqual(end, len(responses))
+        self.assertEqual(first['use_count']['__stdlib__.os.attribute_99999'], 1)
+        self.assertEqual(second['use_count']['__stdlib__.__grammar__.ClassDef'], 2)
+
     def test_stop(self):
         with parser() as server:
             kill(server.pid, SIGTERM)
             server.join()
             self.assertEqual(server.exitcode, SIGTERM)
 
+    def test_restart_crashed_child(self):
+        with parser(workers=1) as server:
+            child, = wait_for_children(server.pid, 1)
+            kill(child, SIGKILL)
+            children = wait_for_children(server.pid, 1, exclude=child)
+            self.assertEqual(len(children), 1)
+            self.assertNotEqual(children[0], child)
+
+    def test_stop_after_giving_up_on_a_child(self):
+        with parser(workers=2) as server:
+            crashing, survivor = wait_for_children(server.pid, 2)
+            for i in range(RESTART_LIMIT + 1):
+                kill(crashing, SIGKILL)
+                children = wait_for_children(server.pid, 1 if i == RESTART_LIMIT else 2, exclude=crashing)
+                crashing, = [ child for child in children if child != survivor ] or [ None ]
+            self.assertEqual(children, [survivor])
+            kill(server.pid, SIGTERM)
+            server.join()
+            self.assertEqual(server.exitcode, SIGTERM)
+            deadline = time() + 5
+            while is_running(survivor) and time() < deadline:
+                sleep(0.05)
+            self.assertFalse(is_running(survivor))
+
     def test_many_clients_forked_server(self):
         num_clients = 10
         num_connections = 10
@@ -187,6 +314,23 @@ class AsyncTest(TestCase):
                 process.join()
     
 
+class RestartBudgetTest(TestCase):
+
+    def test_limit(self):
+        budget = RestartBudget(limit=2, window=60)
+        self.assertTrue(budget.spend(0))
+        self.assertTrue(budget.spend(1))
+        self.assertFalse(budget.spend(2))
+
+    def test_window(self):
+        budget = RestartBudget(limit=2, window=60)
+        self.assertTrue(budget.spend(0))
+        self.assertTrue(budget.spend(1))
+        self.assertFalse(budget.spend(59))
+        self.assertTrue(budget.spend(60))
+        self.assertFalse(budget.spend(60.5))
+
+
 if __name__ == '__main__':
     _main()
 